@@ -1,28 +1,95 @@
 """
-    This code implements a stop n go protocol for handling packet loss
-    over a TCP connection. The TCP connection is simulated by provided
-    files.
+    This code implements a selective repeat sliding window protocol for
+    handling packet loss over a TCP connection. The TCP connection is
+    simulated by provided files.
 """
 
-from statistics import mean
 import socket
+import select
+import selectors
 import io
 import time
 import struct
-import pandas as pd
+import logging
 import util
 import util.logging
 
 # Constants for packet type
 DATA_PACKET = 0
 ACK_P = 1
-queue = []
+
+# Packet header: 16 bit packet type, 32 bit sequence number and 16 bit
+# transmission number. The transmission number counts resends of a data
+# packet and is echoed back in its ACK, so the sender knows which copy an
+# ACK answers and can take RTT samples from retransmitted packets.
+# Compiled once so packing and unpacking skip format string parsing.
+HEADER = struct.Struct("!HIH")
+MAX_TRANSMISSION = 0xFFFF
+HEADER_SIZE = HEADER.size
+
+# Where available, sendmsg() gathers the header and a view into the data
+# into one datagram in the kernel, so payloads are never copied in Python.
+# Elsewhere (e.g. Windows) each packet is assembled in a buffer instead.
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Maximum number of unacknowledged packets the sender keeps in flight.
+# A full window plus its ACKs is up to 2 * WINDOW_SIZE packets on the wire,
+# so the protocol assumes the simulated wire buffers at least that many
+# (grade.py uses 10 to 50). Smaller buffers, such as tester.py's default of
+# 2, still deliver the data correctly, but packets that overflow the buffer
+# are dropped and have to be retransmitted.
+WINDOW_SIZE = 4
+
+# EWMA weights given to each new RTT sample in the smoothed RTT and in the
+# RTT deviation estimate
+RTT_ALPHA = .3
+RTT_BETA = .25
+
+# Retransmission timeout used until the first RTT sample arrives. Kept
+# conservative (as in RFC 6298) so a slow first round trip is not mistaken
+# for loss.
+INITIAL_RTO = 1.0
+
+# The retransmission timeout is the smoothed RTT plus RTO_K deviations,
+# clamped to [MIN_RTO, MAX_RTO], and only moved when it would change by more
+# than RTO_HYSTERESIS (relative) so it does not jitter with every sample.
+RTO_K = 4
+MIN_RTO = .02
+MAX_RTO = 2.0
+RTO_HYSTERESIS = .15
+
+# Requested kernel send / receive buffer size for the socket, in bytes
+SOCK_BUF_SIZE = 4 * 1024 * 1024
+
+
+def _next_rto(smoothed_rtt: float, rtt_var: float,
+              current_rto: float) -> float:
+    """Returns the retransmission timeout to use given new RTT estimates,
+    keeping current_rto if the change would be within the hysteresis band.
+    """
+    new_rto = min(max(smoothed_rtt + RTO_K * rtt_var, MIN_RTO), MAX_RTO)
+    if abs(new_rto - current_rto) / current_rto > RTO_HYSTERESIS:
+        return new_rto
+    return current_rto
+
+
+def _size_socket_buffers(sock: socket.socket, logger: logging.Logger):
+    """Requests SOCK_BUF_SIZE byte kernel send and receive buffers for the
+    socket, logging the size actually granted if the kernel caps it (e.g.
+    at net.core.wmem_max / rmem_max).
+    """
+    for option, name in ((socket.SO_SNDBUF, "send"),
+                         (socket.SO_RCVBUF, "receive")):
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCK_BUF_SIZE)
+        granted = sock.getsockopt(socket.SOL_SOCKET, option)
+        if granted < SOCK_BUF_SIZE:
+            logger.info("Socket %s buffer capped at %d bytes", name, granted)
 
 
 def send(sock: socket.socket, data: bytes):
     """
     Implementation of the sending logic for sending data over a slow,
-    lossy, constrained network using Stop-and-Wait ARQ.
+    lossy, constrained network using Selective Repeat ARQ.
 
     Args:
         sock -- A socket object, constructed and initialized to communicate
@@ -30,50 +97,141 @@ def send(sock: socket.socket, data: bytes):
         data -- A bytes object, containing the data to send over the network.
     """
     logger = util.logging.get_logger("project-sender")
-    offsets = range(0, len(data), util.MAX_PACKET - 4)
-    sock.settimeout(.05)
-    sequence_number = 0
+    # Checked once up front so disabled log calls cost nothing per packet
+    log_info = logger.isEnabledFor(logging.INFO)
+    payload_size = util.MAX_PACKET - HEADER_SIZE
+    data_view = memoryview(data)
+    num_packets = -(-len(data) // payload_size)
+    # One reusable buffer per window slot; sequence numbers map onto slots
+    # modulo the window size, so a slot is only reused once it is acked.
+    # With sendmsg() a slot only has to hold the header.
+    if HAS_SENDMSG:
+        transmit = sock.sendmsg
+        slot_size = HEADER_SIZE
+    else:
+        transmit = sock.send
+        slot_size = util.MAX_PACKET
+    packet_bufs = [bytearray(slot_size) for _ in range(WINDOW_SIZE)]
+    # Sized for a full packet so oversized datagrams are detected rather
+    # than silently truncated to a valid-looking header.
+    ack_buf = bytearray(util.MAX_PACKET)
+    ack_view = memoryview(ack_buf)
+    smoothed_rtt = None
+    rtt_var = None
+    # Timeout derived from the RTT estimates, and the one in effect, which
+    # is backed off from it until a new RTT sample is taken
+    estimated_rto = INITIAL_RTO
+    rto = estimated_rto
+    _size_socket_buffers(sock, logger)
+    base = 0
+    next_seq = 0
+    # Sequence number -> [packet, header buffer, time it was last sent,
+    # transmission number of that send]
+    unacked = {}
+    # Names used per packet, bound locally so the loops do fast local
+    # loads instead of global and attribute lookups
+    data_packet = DATA_PACKET
+    ack_packet = ACK_P
+    header_size = HEADER_SIZE
+    window_size = WINDOW_SIZE
+    alpha = RTT_ALPHA
+    beta = RTT_BETA
+    use_sendmsg = HAS_SENDMSG
+    pack_header = HEADER.pack_into
+    iter_headers = HEADER.iter_unpack
+    recv_into = sock.recv_into
+    wait_readable = select.select
+    clock = time.time
 
     try:
-        for chunk in [data[i:i + util.MAX_PACKET] for i in offsets]:
-            packet = struct.pack("!HH", DATA_PACKET, sequence_number) + chunk
-            sock.send(packet)
-            logger.info("Sent packet with sequence number %d", sequence_number)
+        while base < num_packets:
+            # Fill the window
+            while next_seq < num_packets and next_seq - base < window_size:
+                offset = next_seq * payload_size
+                chunk = data_view[offset:offset + payload_size]
+                packet_buf = packet_bufs[next_seq % window_size]
+                pack_header(packet_buf, 0, data_packet, next_seq, 0)
+                if use_sendmsg:
+                    packet = [packet_buf, chunk]
+                else:
+                    packet_len = header_size + len(chunk)
+                    packet_buf[header_size:packet_len] = chunk
+                    packet = memoryview(packet_buf)[:packet_len]
+                transmit(packet)
+                unacked[next_seq] = [packet, packet_buf, clock(), 0]
+                if log_info:
+                    logger.info(
+                        "Sent packet with sequence number %d", next_seq)
+                next_seq += 1
 
-            # Wait for ACK
-            start_time = time.time()
-            while True:
-                try:
-                    ack = sock.recv(util.MAX_PACKET)
-                    ack_type, ack_sequence = struct.unpack("!HH", ack)
+            # Wait for an ACK, at most until the oldest packet times out
+            oldest_sent = min(entry[2] for entry in unacked.values())
+            wait = max(0, oldest_sent + rto - clock())
+            readable, _, _ = wait_readable([sock], [], [], wait)
 
-                    if len(queue) > 5:
-                        queue.clear()
+            if readable:
+                ack_len = recv_into(ack_buf)
+                if not ack_len or ack_len % header_size:
+                    if log_info:
+                        logger.info(
+                            "Ignoring malformed ACK of %d bytes", ack_len)
+                    continue
 
-                    if ack_type == ACK_P and ack_sequence == sequence_number:
-                        elapsed_time = time.time() - start_time
-                        queue.append(elapsed_time)
-                        rtt_series = pd.Series(queue)
+                # The receiver coalesces the ACKs for a batch of packets
+                # into a single datagram
+                now = clock()
+                for ack_type, ack_sequence, ack_transmission in (
+                        iter_headers(ack_view[:ack_len])):
+                    if ack_type == ack_packet and ack_sequence in unacked:
+                        _, _, sent, transmission = unacked.pop(ack_sequence)
+                        # Karn's rule: only an ACK for the most recent copy
+                        # is timed against its send time; one for an
+                        # earlier copy is no RTT sample
+                        if ack_transmission == transmission:
+                            elapsed_time = now - sent
+                            if smoothed_rtt is None:
+                                smoothed_rtt = elapsed_time
+                                rtt_var = elapsed_time / 2
+                            else:
+                                rtt_var = (
+                                    beta * abs(smoothed_rtt - elapsed_time) +
+                                    (1 - beta) * rtt_var)
+                                smoothed_rtt = (alpha * elapsed_time +
+                                                (1 - alpha) * smoothed_rtt)
+                            estimated_rto = _next_rto(
+                                smoothed_rtt, rtt_var, estimated_rto)
+                            # Only a valid sample ends backoff (RFC 6298);
+                            # resetting on any ACK could pin the timeout
+                            # below the real RTT
+                            rto = estimated_rto
+                        if log_info:
+                            logger.info(
+                                "Received ACK for sequence number %d",
+                                ack_sequence)
+                while base < next_seq and base not in unacked:
+                    base += 1
+                continue
 
-                        moving_averages = round(rtt_series.ewm(
-                            alpha=.3, adjust=True
-                        ).mean(), 5)
-                        sock.settimeout(mean(moving_averages.tolist()))
+            # Retransmit every packet whose timer has expired
+            now = clock()
+            expired = False
+            for sequence_number, entry in unacked.items():
+                if now - entry[2] >= rto:
+                    entry[3] = min(entry[3] + 1, MAX_TRANSMISSION)
+                    pack_header(entry[1], 0, data_packet, sequence_number,
+                                entry[3])
+                    transmit(entry[0])
+                    entry[2] = clock()
+                    expired = True
+                    if log_info:
                         logger.info(
-                            "Received ACK for sequence number %d", sequence_number)  # noqa
-                        break
-                except socket.timeout:
-                    elapsed_time = time.time() - start_time
-                    queue.append(elapsed_time)
-                    rtt_series = pd.Series(queue)
-
-                    moving_averages = round(rtt_series.ewm(
-                        alpha=1, adjust=True
-                    ).mean(), 5)
-                    sock.settimeout(mean(moving_averages.tolist()))
-                    sock.send(packet)
-                    start_time = time.time()
-            sequence_number = 1 - sequence_number
+                            "Resent packet with sequence number %d",
+                            sequence_number)
+            # An expired timer only bounds the RTT from below, so rather than
+            # feeding it into the estimate, back off exponentially until an
+            # ACK for the latest copy of a packet gives a valid sample.
+            if expired:
+                rto = min(rto * 2, MAX_RTO)
     except socket.error as e:
         logger.error("Socket error occurred: %s", str(e))
 
@@ -81,7 +239,7 @@ def send(sock: socket.socket, data: bytes):
 def recv(sock: socket.socket, dest: io.BufferedIOBase) -> int:
     """
     Implementation of the receiving logic for receiving data over a slow,
-    lossy, constrained network using Stop-and-Wait ARQ.
+    lossy, constrained network using Selective Repeat ARQ.
 
     Args:
         sock -- A socket object, constructed and initialized to communicate
@@ -91,46 +249,115 @@ def recv(sock: socket.socket, dest: io.BufferedIOBase) -> int:
         The number of bytes written to the destination.
     """
     logger = util.logging.get_logger("project-receiver")
+    # Checked once up front so disabled log calls cost nothing per packet
+    log_info = logger.isEnabledFor(logging.INFO)
     num_bytes = 0
     expected_sequence_number = 0
+    # Out-of-order payloads held until the gap before them is filled
+    pending = {}
+    recv_buf = bytearray(util.MAX_PACKET)
+    recv_view = memoryview(recv_buf)
+    # ACKs for the current batch, packed back to back and sent together as
+    # one datagram once the batch is drained
+    ack_buf = bytearray(util.MAX_PACKET)
+    ack_view = memoryview(ack_buf)
+    ack_len = 0
+    # Wait for readiness once per batch, then drain every queued datagram
+    # with non-blocking reads until the socket reports it is empty.
+    sock.setblocking(False)
+    _size_socket_buffers(sock, logger)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    # Names used per packet, bound locally so the loops do fast local
+    # loads instead of global and attribute lookups
+    data_packet = DATA_PACKET
+    ack_packet = ACK_P
+    header_size = HEADER_SIZE
+    max_packet = util.MAX_PACKET
+    pack_header = HEADER.pack_into
+    unpack_header = HEADER.unpack_from
+    recv_into = sock.recv_into
+    write = dest.write
+
+    try:
+        while True:
+            selector.select()
+            while True:
+                try:
+                    packet_len = recv_into(recv_buf)
+                except BlockingIOError:
+                    break
+                if packet_len < header_size:
+                    if log_info:
+                        logger.info("Ignoring malformed packet of %d bytes",
+                                    packet_len)
+                    continue
+
+                packet_type, sequence_number, transmission = unpack_header(
+                    recv_buf)
+
+                if packet_type == ack_packet:
+                    # Ignore duplicate ACKs
+                    if log_info:
+                        logger.info(
+                            "Received duplicate ACK for sequence number %d",
+                            sequence_number)
+                    continue
+                if packet_type != data_packet:
+                    if log_info:
+                        logger.info("Ignoring packet of unknown type %d",
+                                    packet_type)
+                    continue
+
+                # Every data packet is acknowledged, including duplicates
+                # whose earlier ACK may have been lost. If the ACK buffer
+                # is full, send it early, flushing first as at batch end.
+                if ack_len + header_size > max_packet:
+                    dest.flush()
+                    sock.send(ack_view[:ack_len])
+                    ack_len = 0
+                pack_header(ack_buf, ack_len, ack_packet, sequence_number,
+                            transmission)
+                ack_len += header_size
 
-    while True:
-        try:
-            packet = sock.recv(util.MAX_PACKET)
-            if not packet:
-                break
-
-            packet_type, sequence_number = struct.unpack("!HH", packet[:4])
-
-            if packet_type == DATA_PACKET and sequence_number == expected_sequence_number:  # noqa
-                logger.info(
-                    "Received packet with sequence number %d", sequence_number)
-                dest.write(packet[4:])
-                dest.flush()
-                num_bytes += len(packet) - 4
-                # Send ACK
-                ack = struct.pack("!HH", ACK_P, sequence_number)
-                sock.send(ack)
-                logger.info("Sent ACK for sequence number %d", sequence_number)
-
-                expected_sequence_number = 1 - expected_sequence_number
-            elif packet_type == ACK_P:
-                # Ignore duplicate ACKs
-                logger.info(
-                    "Received duplicate ACK for sequence number %d", sequence_number)  # noqa
-            elif sequence_number != expected_sequence_number:
-                logger.info("duplicate packet found")
-                ack = struct.pack("!HH", ACK_P, sequence_number)
-                sock.send(ack)
-                logger.info("Sent ACK for sequence number %d", sequence_number)
-            else:
-                # Handle packet loss or corruption
-                logger.info(
-                    "Received out-of-sequence packet or corrupted packet. Ignoring.")  # noqa
-        except socket.timeout:
-            logger.info("Timed out durring reception")
-        except socket.error as e:
-            logger.error("Socket error occurred: %s", str(e))
-            break
+                if sequence_number == expected_sequence_number:
+                    if log_info:
+                        logger.info("Received packet with sequence number %d",
+                                    sequence_number)
+                    write(recv_view[header_size:packet_len])
+                    num_bytes += packet_len - header_size
+                    expected_sequence_number += 1
+
+                    # Deliver anything buffered that is now in order
+                    while expected_sequence_number in pending:
+                        payload = pending.pop(expected_sequence_number)
+                        write(payload)
+                        num_bytes += len(payload)
+                        expected_sequence_number += 1
+                elif sequence_number > expected_sequence_number:
+                    if log_info:
+                        logger.info(
+                            "Buffered out-of-order packet with sequence "
+                            "number %d", sequence_number)
+                    # recv_buf is reused, so buffered payloads need their
+                    # own copy
+                    pending[sequence_number] = bytes(
+                        recv_view[header_size:packet_len])
+                elif log_info:
+                    logger.info("duplicate packet found")
+
+            # The batch is drained. The receiver is normally stopped by a
+            # signal rather than returning, so flush before acknowledging
+            # anything instead of only at exit.
+            dest.flush()
+            if ack_len:
+                sock.send(ack_view[:ack_len])
+                if log_info:
+                    logger.info("Sent %d ACKs", ack_len // header_size)
+                ack_len = 0
+    except socket.error as e:
+        logger.error("Socket error occurred: %s", str(e))
 
+    selector.close()
+    dest.flush()
     return num_bytes